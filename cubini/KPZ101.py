@@ -1,8 +1,62 @@
-import struct
-import time
 import usb
-from vcp_terminal import ComPort
-from struct import pack
+from cubini.vcp_terminal import ComPort
+from enum import IntEnum
+from struct import Struct
+
+# precompiled APT message structs, header is message id (2B), param1, param2, dest, source
+_STRUCT_5B = Struct('<HBBBB')
+_STRUCT_HBBBBHH = Struct('<HBBBBHH')
+_STRUCT_IOSET = Struct('<HBBBBHHHHH')
+_STRUCT_PI = Struct('<HBBBBHHH')
+_STRUCT_U16 = Struct('<H')
+_STRUCT_LUT = Struct('<HBBBBHHh')
+
+_PACK_5B = _STRUCT_5B.pack
+_PACK_HBBBBHH = _STRUCT_HBBBBHH.pack
+_PACK_IOSET = _STRUCT_IOSET.pack
+_PACK_PI = _STRUCT_PI.pack
+_PACK_U16 = _STRUCT_U16.pack
+_PACK_LUTPARAMS = Struct('<HBBBBHHHllllHlH').pack
+
+
+class InputMode(IntEnum):
+    """
+    VoltSrc values of MGMSG_PZ_SET_INPUTVOLTSSRC, see KPZ101.INPUT_MODE.
+    """
+    SOFTWARE = 0x00
+    EXTERNAL = 0x01
+    POTENTIOMETER = 0x02
+
+
+# MAX_VOLTAGE -> VOLTAGELIMIT byte of MGMSG_PZ_SET_TPZ_IOSETTINGS
+_VOLTAGE_LIMIT_BYTE = {75: 0x01, 100: 0x02, 150: 0x03}
+
+try:
+    # compiled fast path, see _apt.pyx
+    from cubini._apt import scaled_frame
+except ImportError:
+    def scaled_frame(prologue, v, sf):
+        # prologue followed by v * sf rounded half up to an unsigned short
+        return prologue + _PACK_U16(int(sf * v + 0.5))
+
+# multi-frame writes are split into chunks of about this many bytes, each with a timeout
+# scaled to the time the 115200 baud link (11520 B/s) needs to drain it
+_WRITE_CHUNK_BYTES = 1024
+_LINK_BYTES_PER_S = 11520
+
+try:
+    # optional JIT for converting long waveforms to device units
+    from numba import njit
+    import numpy as np
+
+    @njit(cache=True)
+    def _to_device_units(v, sf, out):
+        for i in range(v.size):
+            out[i] = np.int16(v[i] * sf + 0.5)
+except ImportError:
+    def _to_device_units(v, sf, out):
+        # v is non negative, so the truncating cast rounds half up
+        out[:] = v * sf + 0.5
 
 
 class KPZ101(object):
@@ -11,7 +65,9 @@ class KPZ101(object):
     destination = 0x50
     source = 0x01
 
-    MAX_POSITION = 30 # micrometers
+    # The scale factors below are derived from MAX_POSITION and MAX_VOLTAGE when the object is created and
+    # whenever set_max_voltage or configure is called, they are not meant to be assigned directly.
+    MAX_POSITION = 30 # micrometers, travel of the actuator, set before creating the object
     position_to_device_unit_sf = 32767. / MAX_POSITION     # scale factor
 
     # The piezo actuator connected to the T-Cube has a specific  maximum operating voltage range.
@@ -48,7 +104,21 @@ class KPZ101(object):
     # 0x02 Potentiometer: The HV amp output is controlled by a potentiometer input (either on the control panel, or
     # connected to the rear panel User I/O D-type connector) summed with the voltage set using the SetVoltOutput method.
     # The values can be 'bitwise ord' to sum the software source with either or both of the other source options.
-    INPUT_MODE = 0x00
+    # INPUT_MODE is validated on assignment, an invalid mode raises ValueError.
+    _input_mode = InputMode.SOFTWARE
+
+    @property
+    def INPUT_MODE(self):
+        return self._input_mode
+
+    @INPUT_MODE.setter
+    def INPUT_MODE(self, input_mode):
+        self._input_mode = InputMode(input_mode)
+
+    # Size of the waveform generator look up table, 512 values (indices 0 to 511) as documented for the TPZ001.
+    # The KPZ101 limit is not documented, the TPZ001 value is used as a conservative bound.
+    # The LUT values are clocked out at 4 kHz, DelayTime adds sample intervals between values.
+    MAX_LUT_SAMPLES = 512
 
     def __init__(self, serial_number=None):
         self.com = None
@@ -56,84 +126,127 @@ class KPZ101(object):
         # find matching USB devices
         devs = usb.core.find(find_all=True, idVendor=0x0403, idProduct=0xfaf0)
         kpz = None
+        serial_number_str = str(serial_number)
         for dev in devs:
             try:
-                sn = usb.util.get_string(dev, dev.iSerialNumber)
-                if sn == str(serial_number):
+                # reading the serial number is a control transfer, stop querying devices once matched
+                if usb.util.get_string(dev, dev.iSerialNumber) == serial_number_str:
                     kpz = dev
-                    #print(kpz)
-            except:
-                pass
-            
+                    break
+            except Exception:
+                continue
+
         assert kpz is not None, 'No KPZ101 with matching serial number {} found!'.format(serial_number)
         
-        time.sleep(.1)
         # open serial communication channel with the device
         self.com = ComPort(usb_device=kpz)
+        self._write = self.com.write
+
+        # constant part (header + channel) of the set output volts / position messages, only the last 2B vary
+        self._outvolts_prologue = _PACK_HBBBBHH(0x0643, 0x04, 0x00, self.destination | 0x80, self.source, self.channel, 0)[:8]
+        self._outpos_prologue = _PACK_HBBBBHH(0x0646, 0x04, 0x00, self.destination | 0x80, self.source, self.channel, 0)[:8]
+        self._update_scale_factors()
         
-        # initialize FTDI chip according to APT documentation
+        # initialize FTDI chip according to APT documentation,
+        # reset and purge it instead of waiting for stale data to settle
+        self.com.purge()
         self.com.setLineCoding(baudrate=115200, databits=8, stopbits=1)
-        time.sleep(.1)
         
         # Get HW info; MGMSG_HW_REQ_INFO; may be require by a K Cube to allow confirmation Rx messages
-        # use the length of the response as a check for uncorrupted communication
-        hw_info = self.get_hwinfo()
-        assert len(hw_info) == 90, 'Communication corrupted for KPZ101 SN {}, response length {} != 90 bytes.'.format(serial_number, len(hw_info))
-
-        time.sleep(0.1)
+        # get_hwinfo checks the response for uncorrupted communication, retry a few times in case the first one is
+        # corrupted by leftovers
+        hw_info = None
+        for _ in range(3):
+            try:
+                hw_info = self.get_hwinfo()
+                break
+            except IOError:
+                continue
+        assert hw_info is not None, 'Communication corrupted for KPZ101 SN {}, no valid MGMSG_HW_GET_INFO response.'.format(serial_number)
 
     def __del__(self):
         if self.com is not None:
             self.com.disconnect()
 
+    def _update_scale_factors(self):
+        # single place deriving the public scale factors and the instance copies read by the hot methods
+        self.voltage_to_device_unit_sf = self._sf = 32767. / self.MAX_VOLTAGE
+        self.position_to_device_unit_sf = self._psf = 32767. / self.MAX_POSITION
+
+    def _write_frames(self, buf, frame_size):
+        """
+        Write back to back frames of frame_size bytes in chunks the link can drain within the write timeout.
+        Raises IOError if a chunk is not written completely.
+        """
+        step = max(1, _WRITE_CHUNK_BYTES // frame_size) * frame_size
+        view = memoryview(buf)
+        for off in range(0, len(buf), step):
+            chunk = view[off:off + step]
+            timeout = 100 + 2000 * len(chunk) // _LINK_BYTES_PER_S    # ms, twice the drain time plus margin
+            written = self.com.write(chunk, timeout)
+            if written != len(chunk):
+                raise IOError('Write failed after {} of {} bytes'.format(off + written, len(buf)))
+
     def get_hwinfo(self):
         """
+        Raises IOError if the response is not a complete MGMSG_HW_GET_INFO message.
         MGMSG_HW_REQ_INFO 0x0005
+        MGMSG_HW_GET_INFO 0x0006
         """
-        self.com.write(pack('<HBBBB', 0x0005, 0x00, 0x00, 0x50, 0x01))
-        time.sleep(0.1)
-        return self.com.readBytes()
+        self._write(_PACK_5B(0x0005, 0x00, 0x00, 0x50, 0x01))
+        return self.com.readReply(0x0006, 90)
 
-    def set_max_voltage(self):
+    def set_max_voltage(self, max_voltage=None):
         """
         Sets the maximum output voltage and update the voltage scale factor.
+        If max_voltage is None the MAX_VOLTAGE attribute is used.
         MGMSG_PZ_SET_TPZ_IOSETTINGS 0x07D4
         """
         # 0x01 VOLTAGELIMIT_75V 75V limit
         # 0x02 VOLTAGELIMIT_100V 100V limit
         # 0x03 VOLTAGELIMIT_150V 150V limit
-        voltage_bytes = {75: 0x01, 100: 0x02, 150: 0x03}
-        voltage_byte = voltage_bytes[self.MAX_VOLTAGE]
-        self.com.write(pack('<HBBBBHHHHH', 0x07D4, 0x0A, 0x00, self.destination | 0x80, self.source, self.channel, voltage_byte, self.FEEDBACK_SOURCE, 0x00, 0x00))
+        if max_voltage is not None:
+            assert max_voltage in _VOLTAGE_LIMIT_BYTE, "Invalid voltage limit, accepted values 75, 100, 150"
+            self.MAX_VOLTAGE = max_voltage
+        voltage_byte = _VOLTAGE_LIMIT_BYTE[self.MAX_VOLTAGE]
+        # the scale factor must match the limit actually sent to the device
+        self._update_scale_factors()
+        self._write(_PACK_IOSET(0x07D4, 0x0A, 0x00, self.destination | 0x80, self.source, self.channel, voltage_byte, self.FEEDBACK_SOURCE, 0x00, 0x00))
     
-    def set_input_mode(self):
+    def set_input_mode(self, input_mode=None):
         """
         Sets the input mode. For documentation check APT docs p. 160.
+        If input_mode (an InputMode or its int value) is None the INPUT_MODE attribute is used.
         MGMSG_PZ_SET_INPUTVOLTSSRC 0x0652
         """
-        assert self.INPUT_MODE in (0x00, 0x01, 0x02), "Invalid input mode"
-        self.com.write(pack('<HBBBBHH', 0x0652, 0x04, 0x00, self.destination | 0x80, self.source, self.channel, self.INPUT_MODE))
+        if input_mode is not None:
+            self.INPUT_MODE = input_mode
+        self._write(_PACK_HBBBBHH(0x0652, 0x04, 0x00, self.destination | 0x80, self.source, self.channel, self.INPUT_MODE))
 
     def enable_channel(self):
         """
         Enables the high voltage ouput.
         MGMSG_MOD_SET_CHANENABLESTATE 0x0210
         """
-        self.com.write(pack('<HBBBB', 0x0210, self.channel, 0x01, self.destination, self.source))
+        self._write(_PACK_5B(0x0210, self.channel, 0x01, self.destination, self.source))
     
     def disable_channel(self):
         """
         Enables the high voltage ouput.
         MGMSG_MOD_SET_CHANENABLESTATE 0x0210
         """
-        self.com.write(pack('<HBBBB', 0x0210, self.channel, 0x02, self.destination, self.source))
+        self._write(_PACK_5B(0x0210, self.channel, 0x02, self.destination, self.source))
 
-    def set_pos_control_mode(self):
+    def set_pos_control_mode(self, pos_control_mode=None):
         """
+        If pos_control_mode is None the POS_CONTROL_MODE attribute is used.
         MGMSG_PZ_SET_POSCONTROLMODE 0x0640
         """
-        assert self.POS_CONTROL_MODE in (0x01, 0x02, 0x03, 0x04), "Invalid control mode"
-        self.com.write(pack('<HBBBB', 0x0640, self.channel, self.POS_CONTROL_MODE, self.destination, self.source))
+        if pos_control_mode is None:
+            pos_control_mode = self.POS_CONTROL_MODE
+        assert pos_control_mode in (0x01, 0x02, 0x03, 0x04), "Invalid control mode"
+        self.POS_CONTROL_MODE = pos_control_mode
+        self._write(_PACK_5B(0x0640, self.channel, self.POS_CONTROL_MODE, self.destination, self.source))
     
     def set_output_voltage(self, v):
         """
@@ -141,12 +254,93 @@ class KPZ101(object):
         MGMSG_PZ_SET_OUTPUTVOLTS 0x0643
         """
         assert 0 <= v <= self.MAX_VOLTAGE, 'Voltage out of limits!'
-        voltage_device_units = int(round(self.voltage_to_device_unit_sf * v))     # short int value to be sent
         # 0x0643 command id
         # 0x04 0x00 data packet length -> 4B (channel 2B + voltage 2B)
         # dest | 0x80 destination, bitwise or cause data packet follows
-        # 4B data packet (channel 2B + voltage 2B)
-        self.com.write(pack('<HBBBBHH', 0x0643, 0x04, 0x00, self.destination | 0x80, self.source, self.channel, voltage_device_units))
+        # 4B data packet (channel 2B + voltage 2B), voltage as short int value = voltage * scale factor rounded half up
+        self._write(scaled_frame(self._outvolts_prologue, v, self._sf))
+
+    def set_output_voltage_raw(self, device_units):
+        """
+        Set the output voltage directly in device units (0 to 32767 corresponds to 0 to MAX_VOLTAGE).
+        No range check and no scaling is done, intended for streaming precomputed waveforms.
+        MGMSG_PZ_SET_OUTPUTVOLTS 0x0643
+        """
+        self._write(self._outvolts_prologue + _PACK_U16(device_units))
+
+    def set_output_voltage_batch(self, device_units):
+        """
+        Send a sequence of output voltages in device units as back to back frames, written in chunks of whole frames
+        (about 1 kB each, see _write_frames). Raises IOError if a chunk is not written completely.
+        The device applies them as fast as it processes the messages, there is no timing between samples.
+        MGMSG_PZ_SET_OUTPUTVOLTS 0x0643
+        """
+        if len(device_units) == 0:
+            return
+        # repeat the 10B frame template and only fill in the voltage word of each frame
+        buf = bytearray((self._outvolts_prologue + b'\x00\x00') * len(device_units))
+        pack_into = _STRUCT_U16.pack_into
+        for i, u in enumerate(device_units):
+            pack_into(buf, 10 * i + 8, u)
+        self._write_frames(buf, 10)
+
+    def set_voltage_waveform(self, v_array):
+        """
+        Convert a whole voltage waveform to device units at once and send it with set_output_voltage_batch,
+        i.e. in chunked writes raising IOError on a short write. Requires numpy.
+        MGMSG_PZ_SET_OUTPUTVOLTS 0x0643
+        """
+        import numpy as np
+        v = np.ascontiguousarray(v_array, dtype=np.float64).ravel()
+        assert v.size == 0 or (v.min() >= 0 and v.max() <= self.MAX_VOLTAGE), 'Voltage out of limits!'
+        out = np.empty(v.size, dtype=np.int16)
+        _to_device_units(v, self._sf, out)
+        self.set_output_voltage_batch(out)
+
+    def upload_lut(self, device_units):
+        """
+        Load a waveform in device units into the waveform generator look up table, starting at index 0.
+        In open loop (POS_CONTROL_MODE 0x01/0x03) the samples are voltages, -32768 to 32767 corresponds to -100% to 100%
+        of MAX_VOLTAGE. In closed loop (0x02/0x04, the class default) the device interprets them as positions,
+        0 to 32767 corresponds to 0 to 100% of MAX_POSITION.
+        MGMSG_PZ_SET_OUTPUTLUT 0x0700
+        """
+        assert len(device_units) <= self.MAX_LUT_SAMPLES, "Too many samples, MAX_LUT_SAMPLES set to {}".format(self.MAX_LUT_SAMPLES)
+        if len(device_units) == 0:
+            return
+        dest = self.destination | 0x80
+        size = _STRUCT_LUT.size
+        buf = bytearray(size * len(device_units))
+        pack_into = _STRUCT_LUT.pack_into
+        for i, u in enumerate(device_units):
+            pack_into(buf, size * i, 0x0700, 0x06, 0x00, dest, self.source, self.channel, i, u)
+        self._write_frames(buf, size)
+
+    def set_lut_params(self, cycle_length, num_cycles=1, delay_time=0, pre_cycle_rest=0, post_cycle_rest=0, continuous=False):
+        """
+        Set how the look up table is output: the first cycle_length values are output num_cycles times
+        (or until stop_lut if continuous), delays are given in sample intervals. Output triggering is not used.
+        MGMSG_PZ_SET_OUTPUTLUTPARAMS 0x0703
+        """
+        assert 0 < cycle_length <= self.MAX_LUT_SAMPLES, "Invalid cycle length, MAX_LUT_SAMPLES set to {}".format(self.MAX_LUT_SAMPLES)
+        # 0x01 OUTPUTLUT_CONTINUOUS, 0x02 OUTPUTLUT_FIXED
+        mode = 0x01 if continuous else 0x02
+        self._write(_PACK_LUTPARAMS(0x0703, 0x1E, 0x00, self.destination | 0x80, self.source, self.channel, mode, cycle_length,
+                                    num_cycles, delay_time, pre_cycle_rest, post_cycle_rest, 0x00, 0x00, 0x00))
+
+    def start_lut(self):
+        """
+        Start the waveform (LUT) output.
+        MGMSG_PZ_START_LUTOUTPUT 0x0706
+        """
+        self._write(_PACK_5B(0x0706, self.channel, 0x00, self.destination, self.source))
+
+    def stop_lut(self):
+        """
+        Stop the waveform (LUT) output.
+        MGMSG_PZ_STOP_LUTOUTPUT 0x0707
+        """
+        self._write(_PACK_5B(0x0707, self.channel, 0x00, self.destination, self.source))
 
     def set_output_position(self, p):
         """
@@ -160,8 +354,7 @@ class KPZ101(object):
         # The output position of the piezo relative to the zero position.
         # The voltage is set as a signed 16-bit integer in the range 0 to 32767 (0 to 7FFF).
         # This corresponds to 0 to 100% of the maximum piezo extension. The negative range (0x800 to FFFF) is not used at this time.
-        position_device_units = int(round(self.position_to_device_unit_sf * p))
-        self.com.write(pack('<HBBBBHH', 0x0646, 0x04, 0x00, self.destination | 0x80, self.source, self.channel, position_device_units))
+        self._write(scaled_frame(self._outpos_prologue, p, self._psf))
 
     def set_proportional_integral_terms(self, proportional, integral):
         """
@@ -169,19 +362,54 @@ class KPZ101(object):
         """
         assert 0 <= proportional <= 255, "Invalid value, accepted values 0-255"
         assert 0 <= integral <= 255, "Invalid value, accepted values 0-255"
-        self.com.write(pack('<HBBBBHHH', 0x0655, 0x06, 0x00, self.destination | 0x80, self.source, self.channel, proportional, integral))
+        self._write(_PACK_PI(0x0655, 0x06, 0x00, self.destination | 0x80, self.source, self.channel, proportional, integral))
+
+    def configure(self, proportional, integral, enable=True, max_voltage=None, input_mode=None, pos_control_mode=None):
+        """
+        Sends the maximum voltage, input mode, position control mode and PI terms (and optionally enables the channel)
+        as back to back APT messages in a single USB write, equivalent to calling the individual setters in this order.
+        max_voltage, input_mode and pos_control_mode are handled like the setter arguments, None keeps the attribute.
+        Nothing is changed or sent if any argument is invalid.
+        """
+        if max_voltage is not None:
+            assert max_voltage in _VOLTAGE_LIMIT_BYTE, "Invalid voltage limit, accepted values 75, 100, 150"
+        if input_mode is not None:
+            input_mode = InputMode(input_mode)     # raises ValueError for an invalid mode
+        if pos_control_mode is None:
+            pos_control_mode = self.POS_CONTROL_MODE
+        assert pos_control_mode in (0x01, 0x02, 0x03, 0x04), "Invalid control mode"
+        assert 0 <= proportional <= 255, "Invalid value, accepted values 0-255"
+        assert 0 <= integral <= 255, "Invalid value, accepted values 0-255"
+        if max_voltage is not None:
+            self.MAX_VOLTAGE = max_voltage
+        if input_mode is not None:
+            self.INPUT_MODE = input_mode
+        self.POS_CONTROL_MODE = pos_control_mode
+        voltage_byte = _VOLTAGE_LIMIT_BYTE[self.MAX_VOLTAGE]
+        # the scale factor must match the limit actually sent to the device
+        self._update_scale_factors()
+        dest = self.destination | 0x80
+        buf = bytearray(_STRUCT_IOSET.size + _STRUCT_HBBBBHH.size + _STRUCT_5B.size + _STRUCT_PI.size + (_STRUCT_5B.size if enable else 0))
+        off = 0
+        _STRUCT_IOSET.pack_into(buf, off, 0x07D4, 0x0A, 0x00, dest, self.source, self.channel, voltage_byte, self.FEEDBACK_SOURCE, 0x00, 0x00)
+        off += _STRUCT_IOSET.size
+        _STRUCT_HBBBBHH.pack_into(buf, off, 0x0652, 0x04, 0x00, dest, self.source, self.channel, self.INPUT_MODE)
+        off += _STRUCT_HBBBBHH.size
+        _STRUCT_5B.pack_into(buf, off, 0x0640, self.channel, self.POS_CONTROL_MODE, self.destination, self.source)
+        off += _STRUCT_5B.size
+        _STRUCT_PI.pack_into(buf, off, 0x0655, 0x06, 0x00, dest, self.source, self.channel, proportional, integral)
+        off += _STRUCT_PI.size
+        if enable:
+            _STRUCT_5B.pack_into(buf, off, 0x0210, self.channel, 0x01, self.destination, self.source)
+        self._write(buf)
 
 
 def test():
     d = KPZ101(29253043)
-    d.set_max_voltage()
-    d.set_input_mode()
-    d.set_pos_control_mode()
-    d.set_proportional_integral_terms(120, 120)
-    d.enable_channel()
+    d.configure(120, 120)
     # d.set_output_voltage(0)
     d.set_output_position(0)
-    print d
+    print(d)
 
 
 if __name__ == '__main__':
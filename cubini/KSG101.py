@@ -1,7 +1,10 @@
 import time
 import usb
-from vcp_terminal import ComPort
-from struct import pack
+from cubini.vcp_terminal import ComPort
+from struct import Struct
+
+# precompiled APT message packers, header is message id (2B), param1, param2, dest, source
+_PACK_5B = Struct('<HBBBB').pack
 
 
 class KSG101(object):
@@ -22,26 +25,32 @@ class KSG101(object):
                 if sn == serial_number:
                     ksg = dev
                     break
-            except:
-                pass
+            except Exception:
+                continue
 
         assert ksg is not None, 'No KPZ101 with matching serial number {} found!'.format(serial_number)
 
-        time.sleep(.1)
         # open serial communication channel with the device
         self.com = ComPort(usb_device=ksg)
+        self._write = self.com.write
 
-        # initialize FTDI chip according to APT documentation
+        # initialize FTDI chip according to APT documentation,
+        # reset and purge it instead of waiting for stale data to settle
+        self.com.purge()
         self.com.setLineCoding(baudrate=115200, databits=8, stopbits=1)
-        time.sleep(.1)
 
         # Get HW info; MGMSG_HW_REQ_INFO; may be require by a K Cube to allow confirmation Rx messages
-        # use the length of the response as a check for uncorrupted communication
-        hw_info = self.get_hwinfo()
-        print hw_info
-        assert len(hw_info) == 90, 'Communication corrupted for KSG101 SN {}, response length {} != 90 bytes.'.format(serial_number, len(hw_info))
-
-        time.sleep(0.1)
+        # get_hwinfo checks the response for uncorrupted communication, retry a few times in case the first one is
+        # corrupted by leftovers
+        hw_info = None
+        for _ in range(3):
+            try:
+                hw_info = self.get_hwinfo()
+                break
+            except IOError:
+                continue
+        print(hw_info)
+        assert hw_info is not None, 'Communication corrupted for KSG101 SN {}, no valid MGMSG_HW_GET_INFO response.'.format(serial_number)
 
     def __del__(self):
         if self.com is not None:
@@ -49,25 +58,26 @@ class KSG101(object):
 
     def get_hwinfo(self):
         """
+        Raises IOError if the response is not a complete MGMSG_HW_GET_INFO message.
         MGMSG_HW_REQ_INFO 0x0005
+        MGMSG_HW_GET_INFO 0x0006
         """
-        self.com.write(pack('<HBBBB', 0x0005, 0x00, 0x00, 0x50, 0x01))
-        time.sleep(0.1)
-        return self.com.readBytes()
+        self._write(_PACK_5B(0x0005, 0x00, 0x00, 0x50, 0x01))
+        return self.com.readReply(0x0006, 90)
 
     def enable_channel(self):
         """
         Enables the high voltage ouput.
         MGMSG_MOD_SET_CHANENABLESTATE 0x0210
         """
-        self.com.write(pack('<HBBBB', 0x0210, self.channel, 0x01, self.destination, self.source))
+        self._write(_PACK_5B(0x0210, self.channel, 0x01, self.destination, self.source))
 
     def disable_channel(self):
         """
         Enables the high voltage ouput.
         MGMSG_MOD_SET_CHANENABLESTATE 0x0210
         """
-        self.com.write(pack('<HBBBB', 0x0210, self.channel, 0x02, self.destination, self.source))
+        self._write(_PACK_5B(0x0210, self.channel, 0x02, self.destination, self.source))
 
     def set_sg_settings(self):
         """
@@ -78,16 +88,15 @@ class KSG101(object):
         """
         MGMSG_PZ_SET_ZERO 0x0658
         """
-        self.com.write(pack('<HBBBB', 0x0658, self.channel, 0x00, self.destination, self.source))
+        self._write(_PACK_5B(0x0658, self.channel, 0x00, self.destination, self.source))
 
     def get_status(self):
         """
         MGMSG_PZ_REQ_PZSTATUSUPDATE 0x0660
         MGMSG_PZ_GET_PZSTATUSUPDATE 0x0661
         """
-        self.com.write(pack('<HBBBB', 0x0660, self.channel, 0x00, self.destination, self.source))
-        time.sleep(0.1)
-        return self.com.readBytes()
+        self._write(_PACK_5B(0x0660, self.channel, 0x00, self.destination, self.source))
+        return self.com.readReply(0x0661, 16)     # 6B header + 10B data
 
     def get_sg_reading(self):
         """
@@ -95,18 +104,50 @@ class KSG101(object):
         MGMSG_PZ_REQ_TSG_READING 0x07DD
         MGMSG_PZ_GET_TSG_READING 0x07DE
         """
-        self.com.write(pack('<HBBBB', 0x07DD, self.channel, 0x00, self.destination, self.source))
-        time.sleep(0.1)
-        return self.com.readBytes()
+        self.request_sg_reading()
+        return self.read_sg_reading()
+
+    def request_sg_reading(self):
+        """
+        Only send the strain gauge reading request, the response is collected with read_sg_reading.
+        MGMSG_PZ_REQ_TSG_READING 0x07DD
+        """
+        self._write(_PACK_5B(0x07DD, self.channel, 0x00, self.destination, self.source))
+
+    def read_sg_reading(self):
+        """
+        Collect the response to request_sg_reading.
+        MGMSG_PZ_GET_TSG_READING 0x07DE
+        """
+        return self.com.readReply(0x07DE, 12)     # 6B header + 6B data
+
+
+def get_sg_readings(ksgs):
+    """
+    Read several strain gauges at once. All requests are sent before any response is awaited,
+    so the device turnaround overlaps across cubes instead of adding up.
+    """
+    for ksg in ksgs:
+        ksg.request_sg_reading()
+    # collect every reply before raising, so one bad cube does not leave the others out of sync
+    readings, error = [], None
+    for ksg in ksgs:
+        try:
+            readings.append(ksg.read_sg_reading())
+        except IOError as e:
+            error = error or e
+    if error is not None:
+        raise error
+    return readings
 
 
 def test():
     d = KSG101(59500009)
     d.enable_channel()
     time.sleep(1)
-    # print d.set_zero()
-    print d.get_status()
-    print d
+    # print(d.set_zero())
+    print(d.get_status())
+    print(d)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,27 @@
+# cython: language_level=3
+"""
+Compiled helpers for the per-command APT send path.
+KPZ101 falls back to an equivalent pure python implementation if this extension is not built.
+"""
+
+from struct import error as struct_error
+
+
+cpdef bytes scaled_frame(bytes prologue, double v, double sf):
+    """
+    Returns the 8B message prologue followed by v * sf rounded to an unsigned short (little endian).
+    """
+    cdef char buf[10]
+    cdef const char *p = prologue
+    cdef long units = <long>(v * sf + 0.5)
+    cdef int k
+    if len(prologue) != 8:
+        raise ValueError("prologue must be 8 bytes long")
+    if units < 0 or units > 0xFFFF:
+        # same exception as the pure python fallback packing with struct
+        raise struct_error("device units {} out of range".format(units))
+    for k in range(8):
+        buf[k] = p[k]
+    buf[8] = <char>(units & 0xFF)
+    buf[9] = <char>((units >> 8) & 0xFF)
+    return buf[:10]
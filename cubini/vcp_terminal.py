@@ -32,6 +32,7 @@
 
 import os
 import sys
+import array
 import time
 import usb.core as usb
 import threading
@@ -118,13 +119,15 @@ class ComPort(object):
         self._ep_out = usb.util.find_descriptor(
             data_itf, custom_match=lambda e: not (
                 e.bEndpointAddress & 0x80))
+        # reception buffer reused by every read of the rx thread
+        self._rxbuf = array.array('B', bytes(self._ep_in.wMaxPacketSize))
 
         if start:
             self._startRx()
 
     def _startRx(self):
         if self._rxthread is not None and (
-                self._rxactive or self._rxthread.isAlive()):
+                self._rxactive or self._rxthread.is_alive()):
             return
         self._rxactive = True
         self._rxthread = threading.Thread(target=self._read)
@@ -136,19 +139,22 @@ class ComPort(object):
 
     def _read(self):
         """ check ep for data, add it to queue and sleep for interval """
+        rxbuf = self._rxbuf
+        put = self._rxqueue.put
         while self._rxactive:
             try:
-                rv = self._ep_in.read(self._ep_in.wMaxPacketSize)
-                if self._isFTDI:
-                    status = rv[:2] # FTDI prepends 2 flow control characters,
+                nread = self._ep_in.read(rxbuf)
+                start = 0
+                if self._isFTDI and nread >= 2:
+                    # FTDI prepends 2 flow control characters,
                     # modem status and line status of the UART
-                    if status[0] != 1 or status[1] != 0x60:
+                    if rxbuf[0] != 1 or rxbuf[1] != 0x60:
                         log.info(
                             "USB Status: 0x{0:02X} 0x{1:02X}".format(
-                                *status))
-                    rv = rv[2:]
-                for rvi in rv:
-                    self._rxqueue.put(rvi)
+                                rxbuf[0], rxbuf[1]))
+                    start = 2
+                for i in range(start, nread):
+                    put(rxbuf[i])
             except usb.USBError as e:
                 log.warn("USB Error on _read {}".format(e))
                 return
@@ -171,15 +177,45 @@ class ComPort(object):
             rx.append(self._rxqueue.get())
         return rx
 
+    def readExact(self, n, timeout=0.5):
+        """ wait until n bytes are received or timeout (sec) expires,
+        returns the bytes received so far, which is shorter than n on
+        timeout; callers must check the length """
+        rx = []
+        deadline = time.time() + timeout
+        while len(rx) < n:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                rx.append(self._rxqueue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return rx
+
+    def readReply(self, msg_id, n, timeout=0.5):
+        """ wait for an n byte reply starting with the little endian 2 byte
+        msg_id, on a short read or another id everything queued is dropped
+        to resync with the device and IOError is raised """
+        rx = self.readExact(n, timeout)
+        if len(rx) != n or rx[0] | (rx[1] << 8) != msg_id:
+            self.readBytes()
+            raise IOError(
+                "Invalid reply, expected {0} bytes of message 0x{1:04X}, "
+                "got {2}".format(n, msg_id, rx))
+        return rx
+
     def readText(self):
         return "".join(chr(c) for c in self.readBytes())
 
-    def write(self, data):
+    def write(self, data, timeout=None):
+        """ write data to the out ep, timeout in ms (None uses the pyusb
+        default), returns the number of bytes written, 0 on USB error """
         try:
-            ret = self._ep_out.write(data)
+            ret = self._ep_out.write(data, timeout)
         except usb.USBError as e:
-            log.warn("USB Error on write {}".format(e))
-            return
+            log.error("USB Error on write {}".format(e))
+            return 0
 
         if len(data) != ret:
             log.error(
@@ -187,6 +223,7 @@ class ComPort(object):
                     len(data), ret))
         else:
             log.debug("{} bytes written to ep".format(ret))
+        return ret
 
     def setControlLineState(self, RTS=None, DTR=None):
         ctrlstate = (2 if RTS else 0) + (1 if DTR else 0)
@@ -312,6 +349,14 @@ class ComPort(object):
             data_or_wLength=0)
         return wlen
 
+    def purge(self):
+        """ reset the FTDI device, purge its rx / tx buffers and drop
+        anything the rx thread already queued
+        """
+        self._resetFTDI()
+        self._flushFTDI()
+        self.readBytes()
+
     def _resetFTDI(self):
         """ reset the FTDI device
         """
@@ -381,14 +426,14 @@ class ComPort(object):
 
     def disconnect(self):
         self._endRx()
-        while self._rxthread is not None and self._rxthread.isAlive():
+        while self._rxthread is not None and self._rxthread.is_alive():
             pass
         usb.util.dispose_resources(self.device)
         if self._rxthread is None:
             log.debug("Rx thread never existed")
         else:
             log.debug("Rx thread is {}".format(
-                "alive" if self._rxthread.isAlive() else "dead"))
+                "alive" if self._rxthread.is_alive() else "dead"))
         attempt = 1
         while attempt < 10:
             try:
@@ -26,11 +26,11 @@ for sn in cuboids:
 # sequentially run a test sequence for each cube
 for kpz in cubinis:
     kpz.set_max_voltage(150)
-    kpz.enable_output()
+    kpz.enable_channel()
     kpz.set_output_voltage(0)
     time.sleep(0.5)
     for v in np.linspace(0, 50, 50):
         kpz.set_output_voltage(v)
         time.sleep(0.1)
     kpz.set_output_voltage(0)
-    kpz.disable_output()
+    kpz.disable_channel()
@@ -1,10 +1,38 @@
 #!/usr/bin/python3
 
 from distutils.core import setup
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
+
+# optional compiled APT packers, the package falls back to pure python without them
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize(['cubini/*.pyx'])
+except ImportError:
+    ext_modules = []
+
+
+class optional_build_ext(build_ext):
+    """ build the extensions if possible, otherwise install the pure python package """
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError as e:
+            print('WARNING: no C compiler available ({0}), using the pure python fallback'.format(e))
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError) as e:
+            print('WARNING: building {0} failed ({1}), using the pure python fallback'.format(ext.name, e))
+
 
 setup(name='cubini',
         version='0.1',
         description='A python interface for Thorlabs KPZ101',
         author='Fabian Thielemann, Vaclav Rada',
-        packages=['cubini']
+        packages=['cubini'],
+        ext_modules=ext_modules,
+        cmdclass={'build_ext': optional_build_ext}
       )